@@ -1,11 +1,63 @@
 import os
+import functools
+import gzip
 import json
-import io
+import logging
+import queue
 import re
-import datetime
+import string
+import sys
+import threading
+import time
 import requests
 import unicodedata
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.types import FlowControl
+from google.pubsub_v1.services.subscriber.transports import SubscriberGrpcTransport
+
+logger = logging.getLogger(__name__)
+
+# Compilado uma vez no import — evita o lookup na cache do re por mensagem
+_CACHE_KEY_RE = re.compile(r"[^a-z0-9_]")
+
+# Tabela para nomes de ficheiro: tudo o que não é [A-Za-z0-9-_] vira "_";
+# um único str.translate (loop em C) substitui o regex + replace por mensagem
+_FILENAME_KEEP = set(map(ord, string.ascii_letters + string.digits + "-_"))
+_FILENAME_TABLE = {i: "_" for i in range(sys.maxunicode + 1) if i not in _FILENAME_KEEP}
+
+_EQ60 = "=" * 60
+
+# Configuração fixa para a vida do processo — lida uma vez no import em vez
+# de um lookup ao environ (e um int()) por mensagem
+_DISCORD_URL = os.environ.get("DISCORD_URL")
+_REDIS_TTL = int(os.environ.get("REDIS_TTL", "3600"))
+if not _DISCORD_URL:
+    print("⚠ DISCORD_URL não configurado, envios para Discord desativados")
+
+# Opções do canal gRPC do subscriber: keepalive agressivo para manter os
+# streams de pull vivos e limite de mensagem generoso para batches grandes
+_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),
+    ("grpc.keepalive_timeout_ms", 10000),
+    ("grpc.http2.max_pings_without_data", 0),
+    ("grpc.max_receive_message_length", 20 * 1024 * 1024),
+]
+
+# Tabela de diacríticos (categoria Mn) construída uma vez no import; permite
+# remover acentos com str.translate em vez de um loop Python por caractere
+_MN_TABLE = {c: None for c in range(sys.maxunicode + 1) if unicodedata.category(chr(c)) == "Mn"}
+
+# ===== Sessão HTTP partilhada (keep-alive + retry com backoff) =====
+_RETRY = Retry(
+    total=5,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"]),
+)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=_RETRY))
 
 # ===== Novo: suporte opcional a Redis =====
 try:
@@ -13,6 +65,23 @@ try:
 except Exception:
     redis = None
 
+# ===== JSON acelerado opcional (orjson é implementado em C) =====
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+else:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False)
+
 def _init_redis():
     """Inicializa cliente Redis opcional a partir de REDIS_URL (pode ser redis://...)."""
     url = os.environ.get("REDIS_URL")
@@ -34,20 +103,26 @@ def _init_redis():
 
 redis_client = _init_redis()
 
+@functools.lru_cache(maxsize=4096)
 def _remove_accents(text):
     """Remove acentos de uma string"""
     if not text:
         return text
     # Normaliza para NFD (separa caracteres base dos diacríticos)
-    nfd = unicodedata.normalize('NFD', text)
-    # Remove os diacríticos (categoria Mn = Nonspacing Mark)
-    return ''.join(char for char in nfd if unicodedata.category(char) != 'Mn')
+    # e elimina-os com translate (loop em C em vez de Python)
+    return unicodedata.normalize('NFD', text).translate(_MN_TABLE)
 
 def send_text_file_to_discord(webhook_url, text, filename="client.txt"):
     """Envia JSON como mensagem para Discord via webhook (sem ficheiro)."""
     try:
         # Envia o JSON no corpo como content (sem anexos)
-        resp = requests.post(webhook_url, json={"content": text}, timeout=15)
+        payload = _json_dumps({"content": text}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        # corpos grandes comprimem 3-10x: menos bytes no upload, POST mais curto
+        if len(payload) > 4096:
+            payload = gzip.compress(payload, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        resp = _SESSION.post(webhook_url, data=payload, headers=headers, timeout=15)
         resp.raise_for_status()
         print(f"✓ Mensagem JSON enviada para Discord ({resp.status_code})")
         return True
@@ -55,63 +130,90 @@ def send_text_file_to_discord(webhook_url, text, filename="client.txt"):
         print(f"✗ Erro ao enviar mensagem para Discord: {e}")
         return False
 
-def _safe_filename(name):
-    """Gera um nome de ficheiro seguro com timestamp"""
+# ===== Fila de envio para Discord (desacopla o ack do RTT do webhook) =====
+_WORK = queue.Queue(maxsize=1024)
+_NUM_WORKERS = int(os.environ.get("DISCORD_WORKERS", "4"))
+
+def _discord_worker():
+    """Worker daemon: consome a fila e executa os envios para o Discord."""
+    while True:
+        webhook_url, text, filename, cache_key = _WORK.get()
+        try:
+            if send_text_file_to_discord(webhook_url, text, filename=filename):
+                print(f"✓ Cliente processado com sucesso: {filename}")
+            else:
+                print(f"✗ Falha ao enviar para Discord: {filename}")
+                # libertar a chave de cache para permitir nova tentativa
+                if cache_key and redis_client:
+                    try:
+                        redis_client.delete(cache_key)
+                    except Exception as e:
+                        print(f"⚠ Não foi possível limpar cache: {e}")
+        finally:
+            _WORK.task_done()
+
+def _start_discord_workers():
+    """Arranca o pool de threads que faz os envios para o Discord."""
+    for _ in range(_NUM_WORKERS):
+        threading.Thread(target=_discord_worker, daemon=True).start()
+
+def _safe_filename(name, ts):
+    """Gera um nome de ficheiro seguro com o timestamp fornecido"""
     name = (name or "cliente").strip()
     # Remove acentos antes de criar o nome do ficheiro
     name = _remove_accents(name)
-    name = re.sub(r"[^A-Za-z0-9\-_\s]", "_", name)
-    name = name.replace(" ", "_")[:50]  # limitar tamanho
-    ts = datetime.datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    name = name.translate(_FILENAME_TABLE)[:50]  # limitar tamanho
     return f"cliente_{name}_{ts}.txt"
 
-def _format_client_text(client):
+def _norm_field(value):
+    """Remove acentos se o valor for string; outros tipos passam inalterados."""
+    if isinstance(value, str):
+        return _remove_accents(value)
+    return value
+
+def _format_client_text(client, now):
     """Formata os dados do cliente em JSON"""
-    now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
-    
-    # Cria uma cópia do cliente com acentos removidos
-    client_normalized = {}
-    for key, value in client.items():
-        if isinstance(value, str):
-            client_normalized[key] = _remove_accents(value)
-        else:
-            client_normalized[key] = value
-    
+
+    # Constrói o JSON diretamente: só os sete campos usados são normalizados,
+    # sem percorrer (nem copiar) o dicionário completo do cliente
     client_json = {
-        "name": client_normalized.get("name"),
-        "email": client_normalized.get("email"),
-        "phone": client_normalized.get("phone"),
-        "company": client_normalized.get("company"),
-        "address": client_normalized.get("address"),
-        "preferred_contact": client_normalized.get("preferred_contact"),
-        "notes": client_normalized.get("notes"),
+        "name": _norm_field(client.get("name")),
+        "email": _norm_field(client.get("email")),
+        "phone": _norm_field(client.get("phone")),
+        "company": _norm_field(client.get("company")),
+        "address": _norm_field(client.get("address")),
+        "preferred_contact": _norm_field(client.get("preferred_contact")),
+        "notes": _norm_field(client.get("notes")),
         "created_at": now
     }
-    
-    return json.dumps(client_json, indent=2, ensure_ascii=False)
+
+    # sem indent: menos trabalho de serialização e menos bytes para o Discord
+    return _json_dumps(client_json)
 
 def _client_cache_key(client):
     """Gera chave de cache baseada em email/phone/nome (normalizado)."""
     identifier = client.get("email") or client.get("phone") or client.get("name") or "unknown"
     identifier = _remove_accents(str(identifier)).lower()
-    identifier = re.sub(r"[^a-z0-9_]", "_", identifier)[:64]
+    identifier = _CACHE_KEY_RE.sub("_", identifier)[:64]
     return f"client_cache:{identifier}"
 
 def callback(message):
     """Processa mensagens do Pub/Sub"""
-    print(f"\n{'='*60}")
-    print(f"Nova mensagem recebida: {message.message_id}")
-    print(f"{'='*60}")
-    
+    logger.debug("Nova mensagem recebida: %s", message.message_id)
+
+
     try:
         # decodificar dados
         raw = message.data
         client_data = {}
         
         try:
-            decoded = json.loads(raw.decode("utf-8"))
-            print(f"Payload JSON: {json.dumps(decoded, indent=2, ensure_ascii=False)}")
-            
+            # json.loads e orjson.loads aceitam bytes — evita um decode extra
+            decoded = _json_loads(raw)
+            # formatação lazy: só serializa o payload se DEBUG estiver ativo
+            logger.debug("Payload JSON: %s", decoded)
+
+
             # extrair dados do cliente
             if isinstance(decoded, dict):
                 if "client" in decoded:
@@ -134,58 +236,66 @@ def callback(message):
                 client_data["notes"] = str(client_data)
             client_data["name"] = "Cliente_Sem_Nome"
         
-        print(f"\nCliente: {client_data.get('name')}")
-        print(f"Email: {client_data.get('email') or '(não fornecido)'}")
-        print(f"Telefone: {client_data.get('phone') or '(não fornecido)'}")
-        
-        # enviar para Discord (com cache Redis opcional)
-        webhook_url = os.environ.get("DISCORD_URL")
-        if not webhook_url:
-            print("⚠ DISCORD_URL não configurado, a ignorar envio")
-        else:
-            filename = _safe_filename(client_data.get("name"))
-            text = _format_client_text(client_data)
+        logger.debug(
+            "Cliente: %s | Email: %s | Telefone: %s",
+            client_data.get("name"),
+            client_data.get("email") or "(não fornecido)",
+            client_data.get("phone") or "(não fornecido)",
+        )
+
 
-            # Verificar cache
+        # enviar para Discord (com cache Redis opcional);
+        # o aviso de URL em falta é emitido uma única vez no arranque
+        if _DISCORD_URL:
+            # Verificar cache ANTES de formatar — um hit dispensa todo o
+            # trabalho de remoção de acentos e serialização
+            cache_key = None
             if redis_client:
                 try:
                     key = _client_cache_key(client_data)
-                    if redis_client.get(key):
+                    # SET NX EX: reclama a chave numa única ida ao Redis (atómico)
+                    if not redis_client.set(key, "1", nx=True, ex=_REDIS_TTL):
                         print(f"✓ Cliente já em cache ({key}), a ignorar envio para Discord")
-                    else:
-                        if send_text_file_to_discord(webhook_url, text, filename=filename):
-                            # TTL configurável via env REDIS_TTL (segundos), padrão 3600s
-                            ttl = int(os.environ.get("REDIS_TTL", "3600"))
-                            try:
-                                redis_client.set(key, "1", ex=ttl)
-                                print(f"✓ Cache gravado: {key} (TTL={ttl}s)")
-                            except Exception as e:
-                                print(f"⚠ Não foi possível gravar cache: {e}")
-                        else:
-                            print(f"✗ Falha ao processar cliente: {client_data.get('name')}")
+                        message.ack()
+                        return
+                    cache_key = key
                 except Exception as e:
                     print(f"⚠ Erro durante operações de cache: {e}")
-                    # fallback: tentar enviar sem cache
-                    if send_text_file_to_discord(webhook_url, text, filename=filename):
-                        print(f"✓ Cliente processado (sem cache): {client_data.get('name')}")
-            else:
-                # Sem Redis -> comportamento original
-                if send_text_file_to_discord(webhook_url, text, filename=filename):
-                    print(f"✓ Cliente processado com sucesso: {client_data.get('name')}")
-                else:
-                    print(f"✗ Falha ao processar cliente: {client_data.get('name')}")
-        
+                    # fallback: continuar sem cache
+
+            # ler o relógio uma vez e partilhar o struct entre os dois formatos
+            now_struct = time.gmtime()
+            filename = _safe_filename(
+                client_data.get("name"), time.strftime("%Y%m%d_%H%M%S", now_struct)
+            )
+            text = _format_client_text(
+                client_data, time.strftime("%Y-%m-%d %H:%M:%S UTC", now_struct)
+            )
+
+            # Delegar o POST aos workers — o ack não espera pelo RTT do Discord
+            try:
+                _WORK.put_nowait((_DISCORD_URL, text, filename, cache_key))
+            except queue.Full:
+                print("⚠ Fila de envio cheia, a devolver mensagem ao Pub/Sub (nack)")
+                if cache_key:
+                    try:
+                        redis_client.delete(cache_key)
+                    except Exception as e:
+                        print(f"⚠ Não foi possível limpar cache: {e}")
+                message.nack()
+                return
+
         message.ack()
-        print(f"{'='*60}\n")
-        
-    except Exception as e:
-        print(f"✗ ERRO ao processar mensagem: {e}")
-        import traceback
-        traceback.print_exc()
+
+
+    except Exception:
+        logger.exception("✗ ERRO ao processar mensagem")
         message.nack()
 
 def main():
     """Inicia o consumer Pub/Sub"""
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+
     project_id = os.environ.get("GCP_PROJECT_ID")
     subscription_id = os.environ.get("PUBSUB_SUBSCRIPTION_ID")
 
@@ -193,25 +303,41 @@ def main():
         print("✗ Erro: GCP_PROJECT_ID e PUBSUB_SUBSCRIPTION_ID devem estar configurados")
         return
 
-    subscriber = pubsub_v1.SubscriberClient()
+    channel = SubscriberGrpcTransport.create_channel(options=_CHANNEL_OPTIONS)
+    subscriber = pubsub_v1.SubscriberClient(transport=SubscriberGrpcTransport(channel=channel))
     subscription_path = subscriber.subscription_path(project_id, subscription_id)
 
-    print("=" * 60)
+    print(_EQ60)
     print("CONSUMER DE CLIENTES - INICIADO")
-    print("=" * 60)
+    print(_EQ60)
     print(f"Projeto: {project_id}")
     print(f"Subscrição: {subscription_id}")
     print(f"Path: {subscription_path}")
-    print(f"Discord: {'Configurado' if os.environ.get('DISCORD_URL') else 'NÃO configurado'}")
-    print("=" * 60)
+    print(f"Discord: {'Configurado' if _DISCORD_URL else 'NÃO configurado'}")
+    print(_EQ60)
     print("\nA aguardar mensagens...\n")
 
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+    _start_discord_workers()
+
+    # Flow control: mais mensagens em voo permite ao cliente agrupar os RPCs de ack
+    flow_control = FlowControl(max_messages=1000, max_bytes=100 * 1024 * 1024)
+
+    # Vários streams de streaming-pull em paralelo — um único stream limita
+    # a taxa de entrega; cada subscribe() abre o seu próprio stream gRPC
+    num_streams = min(os.cpu_count() or 1, 10)
+    print(f"Streams de pull: {num_streams}")
+
+    futures = [
+        subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control)
+        for _ in range(num_streams)
+    ]
 
     try:
-        streaming_pull_future.result()
+        for future in futures:
+            future.result()
     except KeyboardInterrupt:
-        streaming_pull_future.cancel()
+        for future in futures:
+            future.cancel()
         print("\n\n✓ Consumer parado pelo utilizador")
 
 if __name__ == "__main__":